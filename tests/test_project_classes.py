@@ -1,8 +1,315 @@
 import pytest
-from unittest.mock import patch, MagicMock
+import os
+import asyncio
+from unittest.mock import patch, MagicMock, AsyncMock
 from utils.project_classes import *
+from utils.project_classes import _parse_file
 
 # template that would have the tests for the utils
 
+def write_config(path,text,mtime_ns):
+    '''Write a config file and pin its modified time so the cache key is predictable'''
+    path.write_text(text)
+    os.utime(path, ns=(mtime_ns, mtime_ns))
+    return str(path)
+
 class TestParseConfig():
-    pass
\ No newline at end of file
+
+    @pytest.fixture(autouse=True)
+    def clear_cache(self):
+        # each test starts with an empty cache
+        _parse_file.cache_clear()
+        yield
+        _parse_file.cache_clear()
+
+    def test_converts_decimal_values(self,tmp_path):
+        filename = write_config(tmp_path / "config.ini", "[Database]\nport=5432\nhost=localhost\nversion=1.5\n", 10**18)
+
+        config_dict = parse_config(MagicMock(),filename,'Database')
+
+        assert config_dict == {"Database": {"port": 5432, "host": "localhost", "version": "1.5"}}
+
+    def test_missing_section_raises(self,tmp_path):
+        filename = write_config(tmp_path / "config.ini", "[api]\nbase_url=http://localhost:5000\n", 10**18)
+        logger = MagicMock()
+
+        with pytest.raises(ValueError):
+            parse_config(logger,filename,'Database')
+        logger.critical.assert_called_once()
+
+    def test_caller_changes_do_not_touch_cache(self,tmp_path):
+        filename = write_config(tmp_path / "config.ini", "[api_filters]\npage=1\n", 10**18)
+
+        first = parse_config(MagicMock(),filename,'api_filters')
+        first["api_filters"]["page"] += 1
+        second = parse_config(MagicMock(),filename,'api_filters')
+
+        assert second["api_filters"]["page"] == 1
+        assert _parse_file.cache_info().hits == 1
+
+    def test_unchanged_mtime_uses_cache(self,tmp_path):
+        path = tmp_path / "config.ini"
+        filename = write_config(path, "[api]\nconcurrency=8\n", 10**18)
+        parse_config(MagicMock(),filename,'api')
+
+        # same modified time so the stale cached values are returned
+        write_config(path, "[api]\nconcurrency=4\n", 10**18)
+
+        assert parse_config(MagicMock(),filename,'api')["api"]["concurrency"] == 8
+
+    def test_new_mtime_reparses(self,tmp_path):
+        path = tmp_path / "config.ini"
+        filename = write_config(path, "[api]\nconcurrency=8\n", 10**18)
+        parse_config(MagicMock(),filename,'api')
+
+        write_config(path, "[api]\nconcurrency=4\n", 10**18 + 1)
+
+        assert parse_config(MagicMock(),filename,'api')["api"]["concurrency"] == 4
+
+def make_truvi(api=None):
+    '''Create a Truvi object with mocked logger and pool for testing'''
+    config_dict = {"api": api or {"base_url": "http://localhost:5000", "concurrency": 2}}
+    return Truvi(MagicMock(),config_dict,MagicMock(),os.path.dirname(__file__))
+
+def make_record(**overrides):
+    '''Create a record with every raw column filled in'''
+    record = {
+        "booking_id": "b1",
+        "check_in_date": "2024-06-20 22:12:04",
+        "check_out_date": "2024-06-24 22:12:04",
+        "owner_company": "Campos PLC",
+        "owner_company_country": "France",
+    }
+    record.update(overrides)
+    return record
+
+class TestCopyRecords():
+
+    def copy(self,records):
+        '''Run the records through check_write_records and return the COPY statement and payload'''
+        conn = MagicMock()
+        cur = conn.cursor.return_value.__enter__.return_value
+        make_truvi().check_write_records(records,conn)
+        statement, buf = cur.copy_expert.call_args.args
+        return statement, buf.getvalue()
+
+    def test_copy_statement(self):
+        statement,_ = self.copy([make_record()])
+
+        assert statement == (
+            "COPY data.raw_data (booking_id,check_in_date,check_out_date,owner_company,owner_company_country) "
+            "FROM STDIN WITH (FORMAT CSV, NULL '\\N', FREEZE)"
+        )
+
+    def test_column_order_follows_raw_columns(self):
+        # keys in a different order to the table
+        record = dict(reversed(list(make_record().items())))
+
+        _,payload = self.copy([record])
+
+        assert payload == '"b1","2024-06-20 22:12:04","2024-06-24 22:12:04","Campos PLC","France"\n'
+
+    def test_nulls_and_quoting(self):
+        record = make_record(check_out_date=None, owner_company='Garcia, "Hamilton" and Carr', owner_company_country="")
+
+        _,payload = self.copy([record])
+
+        # None is the unquoted null marker, empty strings stay as quoted empty strings
+        assert payload == '"b1","2024-06-20 22:12:04",\\N,"Garcia, ""Hamilton"" and Carr",""\n'
+
+    def test_empty_timestamps_are_null(self):
+        # the api sends a missing date as an empty string, which postgres can't parse as a timestamp
+        record = make_record(check_in_date="", check_out_date="")
+
+        _,payload = self.copy([record])
+
+        assert payload == '"b1",\\N,\\N,"Campos PLC","France"\n'
+
+    def test_no_records_skips_copy(self):
+        conn = MagicMock()
+        make_truvi().check_write_records([],conn)
+        conn.cursor.assert_not_called()
+
+    @pytest.mark.parametrize("record", [
+        {"a": 1, "b": 2, "c": 3, "d": 4, "e": 5},
+        {k: v for k, v in make_record().items() if k != "owner_company"},
+        make_record(extra="value"),
+    ])
+    def test_wrong_columns_raise(self,record):
+        conn = MagicMock()
+        with pytest.raises(ValueError):
+            make_truvi().check_write_records([make_record(),record],conn)
+        conn.cursor.assert_not_called()
+
+class TestFetchThreaded():
+
+    def fake_api(self,requested,per_page,total):
+        '''Create a fake get_api_data that records the pages asked for'''
+
+        def fake_get_api_data(api_parameters):
+            requested.append(api_parameters["page"])
+            return [], {"page": api_parameters["page"], "per_page": per_page, "total": total}
+
+        return fake_get_api_data
+
+    def fetch_pages(self,start_page,per_page,total):
+        '''Return the page numbers fetch_threaded asks for with a fake api'''
+        obj = make_truvi()
+        requested = []
+
+        with patch.object(obj,"get_api_data",side_effect=self.fake_api(requested,per_page,total)):
+            yielded = [page_info["page"] for _,page_info in obj.fetch_threaded({"page": start_page, "per_page": per_page})]
+
+        # pages are requested from several threads but must be yielded in order
+        assert yielded == sorted(requested)
+        return yielded
+
+    def test_no_results_only_fetches_first_page(self):
+        assert self.fetch_pages(1,100,0) == [1]
+
+    def test_exact_multiple(self):
+        assert self.fetch_pages(1,100,300) == [1,2,3]
+
+    def test_partial_last_page(self):
+        assert self.fetch_pages(1,100,250) == [1,2,3]
+
+    def test_later_start_page(self):
+        assert self.fetch_pages(3,100,500) == [3,4,5]
+
+    def test_window_covers_uneven_page_count(self):
+        # concurrency is 2 so the last window only has one page
+        assert self.fetch_pages(1,100,400) == [1,2,3,4]
+
+    def test_pages_in_flight_limited_to_concurrency(self):
+        obj = make_truvi()
+        requested = []
+
+        with patch.object(obj,"get_api_data",side_effect=self.fake_api(requested,100,100000)):
+            pages = obj.fetch_threaded({"page": 1, "per_page": 100})
+            next(pages)
+            next(pages)
+
+            # the first page plus one window of 2, not all 1000 pages
+            assert len(requested) <= 3
+            pages.close()
+
+class TestMain():
+
+    def run_main(self,use_httpx):
+        '''Run Truvi.main with a fake api and database, returning the order things happened in'''
+        events = []
+        obj = make_truvi()
+        obj.api_filters = {"page": 1, "per_page": 100}
+
+        def fake_fetch_threaded(api_parameters):
+            events.append("fetch")
+            yield [make_record()], {"page": 1, "per_page": 100, "total": 1}
+
+        async def fake_fetch_all(api_parameters):
+            events.append("fetch")
+            return [([make_record()], {"page": 1, "per_page": 100, "total": 1})]
+
+        conn = obj.pool.getconn.return_value
+        cur = conn.cursor.return_value.__enter__.return_value
+        cur.execute.side_effect = lambda query: events.append(query)
+        cur.copy_expert.side_effect = lambda query, buf: events.append("copy")
+
+        with patch("utils.project_classes.httpx", MagicMock() if use_httpx else None), \
+                patch.object(obj,"fetch_threaded",side_effect=fake_fetch_threaded), \
+                patch.object(obj,"_fetch_all",side_effect=fake_fetch_all), \
+                patch.object(obj,"post_processing"):
+            obj.main()
+
+        obj.logger.critical.assert_not_called()
+        return events
+
+    @pytest.mark.parametrize("use_httpx", [True, False])
+    def test_pages_fetched_before_truncate(self,use_httpx):
+        events = self.run_main(use_httpx)
+
+        assert events == ["fetch", "SET LOCAL synchronous_commit = off", "TRUNCATE TABLE data.raw_data", "copy"]
+
+class TestPooledConnection():
+
+    def test_open_connection_returned_to_pool(self):
+        pool = MagicMock()
+        pool.getconn.return_value.closed = 0
+
+        with pooled_connection(pool) as conn:
+            pass
+
+        pool.putconn.assert_called_once_with(conn, close=False)
+
+    def test_closed_connection_discarded(self):
+        pool = MagicMock()
+        pool.getconn.return_value.closed = 2
+
+        with pytest.raises(psycopg2.OperationalError):
+            with pooled_connection(pool) as conn:
+                raise psycopg2.OperationalError("server closed the connection")
+
+        pool.putconn.assert_called_once_with(conn, close=True)
+
+class TestScriptMain():
+
+    def test_pool_closed_when_validation_fails(self):
+        pool = MagicMock()
+
+        with patch("utils.project_classes.create_logger"), \
+                patch("utils.project_classes.sys.argv", ["processing.py", "config.ini"]), \
+                patch("utils.project_classes.parse_config", return_value={"Database": {}}), \
+                patch("utils.project_classes.create_pool", return_value=pool), \
+                patch("utils.project_classes.query_local_db", side_effect=psycopg2.OperationalError("bad password")):
+            with pytest.raises(psycopg2.OperationalError):
+                main()
+
+        pool.closeall.assert_called_once()
+
+def make_response(status_code):
+    '''Create a fake http response, raise_for_status only raises for error codes'''
+    response = MagicMock()
+    response.status_code = status_code
+    response.content = b'{"page": 1, "per_page": 100, "total": 1, "results": []}'
+    if status_code >= 400:
+        response.raise_for_status.side_effect = Exception(f"{status_code} error")
+    return response
+
+class TestFetchRetry():
+
+    def fetch(self,statuses):
+        '''Run _fetch against a client returning the given statuses in turn, returning the result, client and sleep mock'''
+        client = MagicMock()
+        client.get = AsyncMock(side_effect=[make_response(status) for status in statuses])
+        sleep = AsyncMock()
+
+        with patch("utils.project_classes.asyncio.sleep", sleep):
+            result = asyncio.run(make_truvi()._fetch(client,asyncio.Semaphore(1),{"page": 1}))
+
+        return result,client,sleep
+
+    def test_retries_gateway_error_then_succeeds(self):
+        data,client,sleep = self.fetch([503,200])
+
+        assert data["page"] == 1
+        assert client.get.await_count == 2
+        sleep.assert_awaited_once_with(RETRY_BACKOFF)
+
+    def test_backoff_doubles_between_attempts(self):
+        _,client,sleep = self.fetch([502,504,200])
+
+        assert client.get.await_count == 3
+        assert [c.args[0] for c in sleep.await_args_list] == [RETRY_BACKOFF, RETRY_BACKOFF * 2]
+
+    def test_other_errors_not_retried(self):
+        with pytest.raises(Exception, match="404"):
+            self.fetch([404])
+
+    def test_last_response_raised_when_retries_run_out(self):
+        client = MagicMock()
+        client.get = AsyncMock(side_effect=[make_response(503) for _ in range(RETRY_TOTAL + 1)])
+
+        with patch("utils.project_classes.asyncio.sleep", AsyncMock()):
+            with pytest.raises(Exception, match="503"):
+                asyncio.run(make_truvi()._fetch(client,asyncio.Semaphore(1),{"page": 1}))
+
+        assert client.get.await_count == RETRY_TOTAL + 1
@@ -1,18 +1,69 @@
 import psycopg2
+import psycopg2.pool
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import sys
 import logging
+import logging.handlers
+import queue
+import atexit
 import time
 import os
+import io
+import json
+import asyncio
+import importlib.util
+from math import ceil
+from functools import lru_cache
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
 from configparser import ConfigParser
 from urllib.parse import urljoin
 import pandas as pd
-from sqlalchemy.engine.url import URL
-from sqlalchemy import create_engine
+
+# columns of data.raw_data in the order the api results are loaded
+RAW_COLUMNS = ["booking_id","check_in_date","check_out_date","owner_company","owner_company_country"]
+
+# timestamp columns in data.raw_data, the api sends a missing date as an empty string which has to load as null
+TIMESTAMP_COLUMNS = ["check_in_date","check_out_date"]
+
+# retry settings for api requests, gateway errors are usually temporary
+RETRY_TOTAL = 3
+RETRY_BACKOFF = 0.3
+RETRY_STATUSES = (502,503,504)
+
+# httpx is optional, pages are fetched with a thread pool without it
+try:
+    import httpx
+except ImportError:
+    httpx = None
+
+# http2 needs the h2 package, httpx falls back to http1.1 without it
+HTTP2 = importlib.util.find_spec("h2") is not None
+
+# orjson is optional, it decodes the api responses faster than the standard library
+try:
+    import orjson
+    _json_loads = orjson.loads
+except ImportError:
+    _json_loads = json.loads
+
+# pyarrow is optional, only needed when writing the final table as parquet
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = None
 
 def create_logger(script_name):
     '''Creates the logger object for the script which writes to the console and a file that has the date as an extension to it'''
 
+    # reuse the logger if it has already been set up, adding the handlers again would duplicate every message
+    logger = logging.getLogger(__name__)
+    if logger.handlers:
+        return logger
+
     # get the current date (year,month,day)
     date_string = time.strftime("%Y-%m-%d", time.localtime())
 
@@ -24,13 +75,13 @@ def create_logger(script_name):
     # Create the log file name in the same directory as the script, with the filedate to differentiate
     filename = os.path.join(log_folder,f"truvi_logger_{date_string}.log")
 
-    # create the log object and set its level
-    logger = logging.getLogger(__name__)
+    # set the level of the log object
     logger.setLevel(logging.DEBUG) 
 
     # create 2 handlers
     # filehandler writes to the log file and will have all messages
-    file_handler = logging.FileHandler(filename)
+    # rotates once the file gets large, and the file is only opened on the first write
+    file_handler = logging.handlers.RotatingFileHandler(filename, maxBytes=50_000_000, backupCount=5, delay=True)
     file_handler.setLevel(logging.DEBUG)
     # consoler handler prints to console but only shows info and above
     console_handler = logging.StreamHandler()
@@ -43,58 +94,110 @@ def create_logger(script_name):
     file_handler.setFormatter(formatter)
     console_handler.setFormatter(formatter)
 
-    # Add the handlers to the logger
-    logger.addHandler(file_handler)
-    logger.addHandler(console_handler)
+    # the logger only puts records on a queue, the listener writes them out on a background thread
+    # so logging doesn't block the main thread on disk writes
+    log_queue = queue.Queue(-1)
+    logger.addHandler(logging.handlers.QueueHandler(log_queue))
+    listener = logging.handlers.QueueListener(log_queue, file_handler, console_handler, respect_handler_level=True)
+    listener.start()
+
+    # keep hold of the listener and make sure anything left on the queue is written on exit
+    logger.listener = listener
+    atexit.register(listener.stop)
 
     return logger
 
-def parse_config(logger,filename,required_section):
-    """Check the config file is valid and contains the needed variables"""
+@lru_cache(maxsize=8)
+def _parse_file(filename,mtime_ns):
+    """Read the config file into a dict of dicts, cached until the file is modified"""
 
     # Create parser and read config file
     parser = ConfigParser()
     parser.read(filename)
 
-    if not parser.has_section(required_section):
+    # local alias avoids a global lookup for every value
+    _int = int
+
+    # Convert all sections to a dict of dicts
+    config_dict = {}
+    for section in parser.sections():
+        # convert any values to integer where possible
+        config_dict[section] = {k: _int(v) if v.isdecimal() else v for k, v in parser.items(section)}
+
+    return config_dict
+
+def parse_config(logger,filename,required_section):
+    """Check the config file is valid and contains the needed variables"""
+
+    # the modified time is part of the cache key so edits to the file are picked up
+    mtime_ns = os.stat(filename).st_mtime_ns if os.path.exists(filename) else None
+    parsed = _parse_file(filename,mtime_ns)
+
+    if required_section not in parsed:
         msg = f"Required section '{required_section}' not found in the {filename} file"
         logger.critical(msg)
         raise ValueError(msg)
 
-    # Convert all sections to a dict of dicts
-    config_dict = {
-        section: {
-            # convert any values to integer where possible
-            k: int(v) if v.isdigit() else v
-            for k, v in parser.items(section)
-        }
-        for section in parser.sections()
-    }
+    # copy the sections as the cached dict must not be changed by the caller
+    config_dict = {section: dict(params) for section, params in parsed.items()}
 
     return config_dict
 
-def query_local_db(logger,query,engine):
-    '''Execute a query against the local database from the config file'''
+def create_pool(logger,database_config,maxconn=8):
+    '''Create a pool of psycopg2 connections to the local database from the config file'''
+
+    # the config uses the sqlalchemy url names so map them onto the psycopg2 ones
+    try:
+        return psycopg2.pool.ThreadedConnectionPool(
+            1,
+            maxconn,
+            user=database_config['username'],
+            password=database_config['password'],
+            dbname=database_config['database'],
+            host=database_config['host'],
+            port=database_config['port']
+        )
+    except psycopg2.OperationalError as e:
+        # operational covers authentication and connection
+        logger.critical("Connection to database failed with %s", e)
+        raise
+
+@contextmanager
+def pooled_connection(pool):
+    '''Borrow a connection from the pool for a single transaction and hand it back afterwards'''
 
+    conn = pool.getconn()
     try:
-        # create connection
-        with engine.begin() as conn:
-            # get the raw psycopg2 connection
-            raw_conn = conn.connection  
-            # create cursor and execute query
-            with raw_conn.cursor() as cur:
-                cur.execute(query)
-
-                # check if there is something to return and return it otherwise have the list that has nothing to return
-                if cur.description is not None:
-                    # If the cursor description is not None, it means there's a result set to fetch
-                    result = cur.fetchall()
-                else:
-                    result = ["No data to return"]
-
-                # begin automatically commits
-                logger.debug(f"{query} executed")
-                return result
+        # the connection commits when the block succeeds and rolls back if it raises
+        with conn:
+            yield conn
+    finally:
+        # a connection that has dropped is discarded rather than handed out again
+        pool.putconn(conn, close=conn.closed != 0)
+
+def query_local_db(logger,query,pool,return_cols=False):
+    '''Execute a query against the local database from the config file, optionally returning the column names with the rows'''
+
+    try:
+        # borrow a connection, create cursor and execute query
+        with pooled_connection(pool) as conn, conn.cursor() as cur:
+            cur.execute(query)
+
+            # check if there is something to return and return it otherwise have the list that has nothing to return
+            if cur.description is not None:
+                # If the cursor description is not None, it means there's a result set to fetch
+                result = cur.fetchall()
+                # the column names come with the result set so no need to look them up separately
+                columns = [col.name for col in cur.description]
+            else:
+                result = ["No data to return"]
+                columns = []
+
+            # the connection commits when the block exits
+            logger.debug("%s executed", query)
+            if return_cols:
+                return result,columns
+            return result
     except (psycopg2.OperationalError,psycopg2.ProgrammingError,psycopg2.IntegrityError,psycopg2.errors.RaiseException) as e:
         # operational covers authentication and connection 
         # programming covers syntax errors in query as well as nonexistent tables and columns
@@ -103,36 +206,66 @@ def query_local_db(logger,query,engine):
         # anything else will break the script as something is badly wrong
 
         # log the error and reraise across the stack
-        logger.critical(f"{query} failed with {e}")
+        logger.critical("%s failed with %s", query, e)
         raise
 
+def _csv_field(value,empty_is_null=False):
+    '''Format a value for COPY, None is written as the null marker and everything else is quoted so empty strings stay empty'''
+
+    # postgres never reads a quoted value as null, so empty strings that should be null need the marker too
+    if value is None or (empty_is_null and value == ""):
+        return "\\N"
+    return '"' + str(value).replace('"','""') + '"'
+
 class Truvi():
     """Encapsulting all the logic into a class"""
 
-    def __init__(self,logger,config_dict,engine,script_dir):
+    def __init__(self,logger,config_dict,pool,script_dir):
 
-        # assign the logger, engine, and working directory
+        # assign the logger, connection pool, and working directory
         self.logger=logger
-        self.engine=engine
+        self.pool=pool
         self.output_folder = os.path.abspath(os.path.join(script_dir, '..'))
 
         # loop through the dict of dicts and assign them as attributes
         for section, params in config_dict.items():
             setattr(self, section, params)
 
+        # every page comes from the same endpoint
+        self._api_url = urljoin(self.api['base_url'],"api/bookings")
+
+        # reuse one session so the connection to the api is kept alive between pages
+        # retry on gateway errors as these are usually temporary
+        self._session = requests.Session()
+        adapter = HTTPAdapter(
+            pool_connections=16,
+            pool_maxsize=16,
+            max_retries=Retry(total=RETRY_TOTAL, backoff_factor=RETRY_BACKOFF, status_forcelist=RETRY_STATUSES)
+        )
+        self._session.mount("http://", adapter)
+        self._session.mount("https://", adapter)
+
     def get_api_data(self,api_parameters):
-        """Connect to the api and return the results as a pandas dataframe"""
+        """Connect to the api and return the results as a list of records"""
 
         # connect to the api
-        response=requests.get(urljoin(self.api['base_url'],"api/bookings"),params=api_parameters)
+        response=self._session.get(self._api_url,params=api_parameters)
+
+        # convert the response into json and split it into the records and pagination details
+        data = self._decode_response(response)
+        return self.parse_api_data(data)
+
+    def _decode_response(self,response):
+        """Check the api response succeeded and decode the json, works for both requests and httpx responses"""
+
         response.raise_for_status()
+        return _json_loads(response.content)
 
-        # convert the response into json and get results from the dictionary
-        data = response.json()
-        results=data['results']
+    def parse_api_data(self,data):
+        """Split the json from an api page into the records and the pagination details"""
 
-        # convert that into a dataframe
-        df = pd.DataFrame(results)
+        # get results from the dictionary
+        results=data['results']
 
         # then get the details from the response to deal with pagination
         page_info = {
@@ -142,102 +275,215 @@ class Truvi():
         }
 
         # return these for the next functions
-        return df,page_info
+        return results,page_info
+
+    def fetch_threaded(self,api_parameters):
+        """Get the first page to find the total and then yield the remaining pages fetched with a thread pool"""
+
+        # the first page is needed to know how many pages there are
+        results,page_info=self.get_api_data(api_parameters)
+        yield results,page_info
+        n_pages = ceil(page_info["total"] / page_info["per_page"])
+        pages = range(page_info["page"] + 1, n_pages + 1)
+        concurrency = self.api.get('concurrency', 8)
+
+        # threads are fine here as the time is spent waiting on the socket, map keeps the pages in order
+        # map submits everything it is given straight away, so hand it one window of pages at a time
+        # the next window is only requested once the previous one has been read
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            for start in range(0, len(pages), concurrency):
+                yield from executor.map(
+                    lambda page: self.get_api_data({**api_parameters, "page": page}),
+                    pages[start:start + concurrency]
+                )
+
+    async def _fetch(self,client,semaphore,api_parameters):
+        """Get a single page from the api, the semaphore limits how many are in flight at once"""
+
+        async with semaphore:
+            # the transport only retries failed connections so retry gateway errors here, matching the requests session
+            for attempt in range(RETRY_TOTAL + 1):
+                response = await client.get(self._api_url,params=api_parameters)
+                if response.status_code not in RETRY_STATUSES or attempt == RETRY_TOTAL:
+                    break
+                await asyncio.sleep(RETRY_BACKOFF * 2 ** attempt)
+
+            return self._decode_response(response)
+
+    async def _fetch_all(self,api_parameters):
+        """Get the first page to find the total and then fetch the remaining pages concurrently"""
+
+        # every page is held in memory until they have all been fetched, so flush_rows only sets the size of each write on this path
+        semaphore = asyncio.Semaphore(self.api.get('concurrency', 8))
+
+        # over https http2 lets every request share one connection instead of one connection per request
+        transport = httpx.AsyncHTTPTransport(
+            http2=HTTP2,
+            limits=httpx.Limits(max_keepalive_connections=16),
+            retries=RETRY_TOTAL
+        )
+        async with httpx.AsyncClient(transport=transport) as client:
+            # the first page is needed to know how many pages there are
+            first = await self._fetch(client,semaphore,api_parameters)
+            n_pages = ceil(int(first['total']) / int(first['per_page']))
+
+            # gather keeps the pages in the order they were requested
+            pages = await asyncio.gather(*(
+                self._fetch(client,semaphore,{**api_parameters, "page": page})
+                for page in range(int(first['page']) + 1, n_pages + 1)
+            ))
+
+        return [self.parse_api_data(first)] + [self.parse_api_data(data) for data in pages]
     
-    def check_write_df(self,df):
-        """Validate the dataframe has correct values as expected and then write to the database"""
+    def check_write_records(self,records,conn):
+        """Validate the records have the values expected and then write to the database using the open connection"""
 
-        if df.empty:
-            self.logger.info("Empty DataFrame")
+        if not records:
+            self.logger.info("No records to write")
             return
-        
-        # basic validation by checking the number of columns (would normally do more)
-        cols= len(df.columns)
-        if cols != 5:
-            raise IndexError(f"df has {cols} columns, expected 5")
-
-        # convert the columns into the correct datatype
-        for key in self.table_values:
-            if key in df.columns:
-                df[key] = pd.to_datetime(df[key])
-                self.logger.debug(f"Converted {key} to datetime")
-
-        # write the dataframe to the database in append mode
-        df.to_sql(schema="data",name="raw_data", con=self.engine, if_exists="append", index=False)
-        self.logger.debug("Dataframe written to database")
+
+        # basic validation by checking every record has exactly the expected columns (would normally do more)
+        expected = set(RAW_COLUMNS)
+        for record in records:
+            if record.keys() != expected:
+                raise ValueError(f"record has columns {sorted(record)}, expected {RAW_COLUMNS}")
+
+        self._copy_records(records,conn)
+
+    def _copy_records(self,records,conn):
+        """Stream the records straight into data.raw_data with COPY, postgres parses the timestamps itself"""
+
+        # write the records into an in memory csv in the same column order as the COPY
+        buf = io.StringIO()
+        empty_is_null = [col in TIMESTAMP_COLUMNS for col in RAW_COLUMNS]
+        for record in records:
+            buf.write(",".join([_csv_field(record[col],null) for col,null in zip(RAW_COLUMNS,empty_is_null)]))
+            buf.write("\n")
+        buf.seek(0)
+
+        # COPY is much faster than to_sql which sends the rows as individual inserts
+        # FREEZE is allowed as the table was truncated earlier in the same transaction
+        with conn.cursor() as cur:
+            cur.copy_expert(
+                f"COPY data.raw_data ({','.join(RAW_COLUMNS)}) FROM STDIN WITH (FORMAT CSV, NULL '\\N', FREEZE)",
+                buf
+            )
+        self.logger.debug("%d records written to database", len(records))
 
     def post_processing(self):
-        """Get the final table from the data"""
+        """Get the final table from the data in the file format set in the config"""
+
+        # the output section is optional so older configs still default to csv
+        if getattr(self, 'output', {}).get('file_format', 'csv') == 'parquet':
+            self.write_parquet()
+        else:
+            self.write_csv()
+
+    def write_parquet(self):
+        """Write the final table to a snappy compressed parquet file"""
+
+        if pa is None:
+            msg = "pyarrow is required to write the final table as parquet"
+            self.logger.critical(msg)
+            raise ImportError(msg)
 
         # view and table exist within the database so get it out of there
-        data=query_local_db(
+        data,columns=query_local_db(
             self.logger,
             "SELECT * FROM data.final_table;",
-            self.engine
+            self.pool,
+            return_cols=True
         )
 
         if len(data) == 0:
             raise ValueError("No data in view, please check")
-        
-        # get the column names
-        raw_cols=query_local_db(
-            self.logger,
-            """
-                SELECT column_name
-                FROM information_schema.columns
-                WHERE table_schema = 'data' AND table_name = 'final_table'
-            """,
-            self.engine
-        )
-        # get them out of the tuple
-        columns = [row[0] for row in raw_cols]
 
-        # create the final df and file path
+        # columnar and compressed so it is much smaller and quicker to read back than csv
         df = pd.DataFrame(data,columns=columns)
-        output_path=os.path.join(self.output_folder,'final_table.csv')
-        
-        # save to csv
-        df.to_csv(
-            output_path,
-            index=False
-        )
-        self.logger.info(f"Final table written to csv in {output_path}")
+        output_path=os.path.join(self.output_folder,'final_table.parquet')
+        tbl = pa.Table.from_pandas(df, preserve_index=False)
+        pq.write_table(tbl, output_path, compression='snappy', use_dictionary=True)
+        self.logger.info("Final table written to parquet in %s", output_path)
 
-    def main(self):
+    def write_csv(self):
+        """Stream the final table into a csv file"""
 
-        # get the intial parameters that will be replaced during the loop
-        api_parameters=self.api_filters
+        output_path=os.path.join(self.output_folder,'final_table.csv')
 
+        # view and table exist within the database so stream it straight into the csv
+        # this avoids pulling every row into python before writing it out
+        # write to a temporary file first so an existing csv is only replaced once the export has worked
+        tmp_path=output_path+'.tmp'
         try:
-            # make sure its empty incase runnng multiple times
-            _=query_local_db(
-                self.logger,
-                "truncate table data.raw_data;",
-                self.engine
-            )
+            with open(tmp_path,'wb') as f, pooled_connection(self.pool) as conn:
+                with conn.cursor() as cur:
+                    cur.copy_expert("COPY (SELECT * FROM data.final_table) TO STDOUT WITH CSV HEADER", f)
+                    rows = cur.rowcount
 
-            # while loop to make sure all pages have been completed
-            while True:
-                # connect to the api and get the data as a dataframe
-                df,page_info=self.get_api_data(api_parameters)
-                self.logger.info(f"Fetched page {page_info['page']} with {len(df)} results")
+            if rows == 0:
+                raise ValueError("No data in view, please check")
 
-                # write the dataframe to the db after cleaning
-                self.check_write_df(df)
+            os.replace(tmp_path,output_path)
+        finally:
+            # tidy up the temporary file if the export failed part way
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
 
-                # break out of the loop there should be no more results in the pages
-                if page_info["page"] * page_info["per_page"] >= page_info["total"]:
-                    self.logger.info("All pages fetched")
-                    break
+        self.logger.info("Final table written to csv in %s", output_path)
+
+    def main(self):
 
-                # increase the page number to continue with the loop
-                api_parameters["page"] += 1
+        # get the filters used for every api request, the page is set per request from these
+        api_parameters=self.api_filters
+
+        # pages are collected and written in bulk rather than one write per page
+        records=[]
+        flush_rows=self.api.get('flush_rows', 50000)
+
+        try:
+            # every page is fetched before the transaction so the truncate doesn't lock raw_data while waiting on the api
+            # this means all pages are held in memory, flush_rows only sets the size of each write
+            if httpx is not None:
+                # the run is spent waiting on the api so fetch the pages concurrently
+                pages=asyncio.run(self._fetch_all(api_parameters))
+            else:
+                # fall back to fetching the pages with a thread pool
+                pages=list(self.fetch_threaded(api_parameters))
+
+            # the truncate and every write share one transaction so there is a single commit for the load
+            # if anything fails the whole load rolls back and the previous raw data is kept
+            with pooled_connection(self.pool) as conn:
+                with conn.cursor() as cur:
+                    # raw_data is only a staging table that is rebuilt every run, so don't wait for the fsync on commit
+                    # a crash can lose this load but the script can just be run again
+                    cur.execute("SET LOCAL synchronous_commit = off")
+
+                    # make sure its empty incase runnng multiple times
+                    cur.execute("TRUNCATE TABLE data.raw_data")
+                self.logger.debug("data.raw_data truncated")
+
+                for results,page_info in pages:
+                    self.logger.info("Fetched page %d with %d results", page_info['page'], len(results))
+
+                    # hold the page until enough rows have built up to write
+                    records.extend(results)
+
+                    # flush early to keep memory bounded for very large totals
+                    if len(records) >= flush_rows:
+                        self.check_write_records(records,conn)
+                        records=[]
+
+                self.logger.info("All pages fetched")
+
+                # write whatever is left over after the final page in one go
+                if records:
+                    self.check_write_records(records,conn)
 
             # post processing to create the final table
             self.post_processing()
 
         except Exception as e:
-            self.logger.critical(f"Processing failed with {e}")
+            self.logger.critical("Processing failed with %s", e)
 
         finally:
             self.logger.info("Object function stopped")
@@ -250,10 +496,10 @@ def main():
 
     # CLI arguments
     if len(sys.argv) != 2:
-        logger.critical(f"Invalid number of CLI arguments: {sys.argv}")
+        logger.critical("Invalid number of CLI arguments: %s", sys.argv)
         logger.critical("Usage: python script_name.py config_file_name")
         sys.exit(1)
-    logger.debug(f"Starting {__file__}")
+    logger.debug("Starting %s", __file__)
 
     # get the current path of the script needed for other functions
     script_dir = os.path.dirname(os.path.abspath(__file__))
@@ -265,21 +511,24 @@ def main():
         'Database'
     )
 
-    # create the engine
-    db_url = URL.create(**config_dict['Database'])
-    engine=create_engine(db_url)
+    # create the connection pool, psycopg2 is used directly as every query only needs a raw cursor
+    pool=create_pool(logger,config_dict['Database'])
 
-    # validate the password against the db
-    _=query_local_db(
-        logger,
-        "SELECT 'janwashere';",
-        engine
-    )
-    logger.info(f"Connection to database valid")
-
-    # create an instance of the object and then run the function
-    obj=Truvi(logger,config_dict,engine,script_dir)
-    obj.main()
+    try:
+        # validate the password against the db
+        _=query_local_db(
+            logger,
+            "SELECT 'janwashere';",
+            pool
+        )
+        logger.info("Connection to database valid")
+
+        # create an instance of the object and then run the function
+        obj=Truvi(logger,config_dict,pool,script_dir)
+        obj.main()
+    finally:
+        # close every connection in the pool even if something failed
+        pool.closeall()
 
     logger.info("Script complete")
     # explicitly return 0